@@ -14,20 +14,31 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import io
 import re
 import csv
 import sys
 import json
 import logging
 import collections as coll
+import multiprocessing as mp
 from enum import Enum
 from codecs import open
 
 import attr
-from attr.validators import instance_of as is_a
 import click
 from obonet.read import read_obo
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -62,301 +73,387 @@ INSDCTypes = Enum(
     ])
 
 
+# Each INSDC type gets one bit, so a set of types is a plain int and the
+# frequent membership, union and removal operations on the hot path are
+# single bit operations instead of frozenset work.
+TYPE_BIT = {rna_type: 1 << index for index, rna_type in enumerate(INSDCTypes)}
+
+
+def mask_to_names(mask):
+    return [rna_type.name for rna_type, bit in TYPE_BIT.items() if mask & bit]
+
+
+def load_json(filename):
+    # orjson parses the manual file several times faster than the stdlib,
+    # but it is optional; fall back to json when it is not installed.
+    with open(filename, 'rb') as handle:
+        raw = handle.read()
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
 def rna_type_to_key(rna_type):
-    return tuple(rna_type.rstrip(';').split('; '))
+    # The same rna_type strings appear across many families; interning the
+    # components deduplicates them and makes dict lookups on the resulting
+    # tuples compare by pointer rather than by character.
+    return tuple(sys.intern(part) for part in rna_type.rstrip(';').split('; '))
 
 
-@attr.s(frozen=True)
+@attr.s(slots=True, frozen=True, eq=False)
 class RfamFamily(object):
-    id = attr.ib(validator=is_a(str))
-    name = attr.ib(validator=is_a(str))
-    so_terms = attr.ib(validator=is_a(set))
-    rna_type = attr.ib(validator=is_a(tuple))
+    id = attr.ib()
+    name = attr.ib()
+    so_terms = attr.ib()
+    rna_type = attr.ib()
 
     @classmethod
     def build_all(cls, link_file, family_file):
-        so_terms = coll.defaultdict(set)
-        with open(link_file, 'r', 'utf-8') as raw:
-            for line in raw:
-                parts = line.split()
-                if parts[1] != 'SO':
-                    continue
-                so_terms[parts[0]].add('SO:%s' % parts[2])
-
+        # Read the link table in one go and let a compiled regex pick out
+        # the SO rows, rather than splitting and filtering every line at
+        # the python level.
+        so_link = re.compile(r'(?m)^(\S+)\s+SO\s+(\S+)')
+        with open(link_file, 'rb') as raw:
+            data = raw.read().decode('utf-8')
+
+        so_terms = {}
+        for match in so_link.finditer(data):
+            family, so_id = match.groups()
+            so_terms.setdefault(sys.intern(family), set()).add(
+                sys.intern('SO:' + so_id))
+
+        # The family file is plain tab separated text with no quoting, so
+        # read it in large chunks and split the lines directly rather than
+        # paying for the csv module's dialect handling per row. Only the
+        # first 19 columns are ever used.
         families = []
-        with open(family_file, 'r', 'iso-8859-1') as raw:
-            for row in csv.reader(raw, delimiter='\t'):
-                family = row[0]
-                name = row[1]
-                rna_type = row[18]
-                families.append(cls(
-                    id=family,
-                    name=name,
-                    so_terms=so_terms[family],
-                    rna_type=rna_type_to_key(rna_type)
-                ))
+        with open(family_file, 'rb') as raw:
+            leftover = b''
+            while True:
+                chunk = raw.read(1024 * 1024)
+                if chunk:
+                    lines = (leftover + chunk).split(b'\n')
+                    leftover = lines.pop()
+                else:
+                    lines = [leftover] if leftover else []
+
+                for line in lines:
+                    if not line:
+                        continue
+                    row = line.decode('iso-8859-1').split('\t', 19)
+                    family = sys.intern(row[0])
+                    families.append(cls(
+                        id=family,
+                        name=sys.intern(row[1]),
+                        so_terms=so_terms.get(family, set()),
+                        rna_type=rna_type_to_key(row[18])
+                    ))
+
+                if not chunk:
+                    break
         return families
 
 
-@attr.s()
+def as_type_mask(result):
+    rna_types = set()
+    if isinstance(result, str):
+        rna_types.add(result)
+    elif isinstance(result, (list, set, tuple, frozenset)):
+        rna_types.update(result)
+    elif result is None:
+        pass
+    else:
+        raise ValueError("Unknown type of result")
+
+    mask = 0
+    for rna_type in rna_types:
+        if rna_type == 'antisense':
+            rna_type = 'antisense_RNA'
+        if rna_type is None:
+            continue
+        mask |= TYPE_BIT[getattr(INSDCTypes, rna_type)]
+    return mask
+
+
+@attr.s(slots=True, frozen=True, eq=False)
 class InferredRfamType(object):
-    family = attr.ib(validator=is_a(RfamFamily))
-    method = attr.ib(validator=is_a(str))
-    rna_types = attr.ib(validator=is_a(frozenset))
-
-    @classmethod
-    def build(cls, family, name, result):
-        rna_types = set()
-        if isinstance(result, str):
-            rna_types.add(result)
-        elif isinstance(result, (list, set, tuple)):
-            rna_types.update(result)
-        elif result is None:
-            pass
-        else:
-            raise ValueError("Unknown type of result")
-
-        final = set()
-        for rna_type in rna_types:
-            if rna_type == 'antisense':
-                rna_type = 'antisense_RNA'
-            if rna_type is None:
-                continue
-            final.add(getattr(INSDCTypes, rna_type))
-
-        return cls(
-            family=family,
-            method=name,
-            rna_types=frozenset(final),
-        )
-
-    def remove(self, value):
-        if value not in self.rna_types:
-            return self
-        return attr.assoc(
-            self,
-            rna_types=frozenset(r for r in self.rna_types if r != value)
-        )
-
-    def simple(self):
-        return {
-            'family': self.family.id,
-            'method': self.method,
-            'rna_types': ';'.join(r.name for r in self.rna_types),
-        }
+    family = attr.ib()
+    method = attr.ib()
+    rna_types = attr.ib()
 
     def __contains__(self, value):
-        return value in self.rna_types
+        return bool(self.rna_types & TYPE_BIT[value])
 
     def __len__(self):
-        return len(self.rna_types)
+        return bin(self.rna_types).count('1')
 
     def __bool__(self):
         return bool(self.rna_types)
 
 
-@attr.s(frozen=True)
+@attr.s(slots=True, frozen=True, eq=False)
 class ManualInference(object):
-    assignments = attr.ib(validator=is_a(dict))
+    assignments = attr.ib()
+    cache = attr.ib(default=attr.Factory(dict), repr=False)
 
     @classmethod
-    def build(cls, filename):
-        with open(filename, 'r', 'utf-8') as handle:
-            loaded = json.load(handle)
-            return cls(assignments=loaded['hardcoded'])
+    def build(cls, loaded):
+        return cls(assignments=loaded['hardcoded'])
 
     @property
     def name(self):
         return 'manual'
 
     def __call__(self, family):
-        return InferredRfamType.build(
-            family,
-            self.name,
-            self.assignments.get(family.id, None)
-        )
+        if family.id in self.cache:
+            return self.cache[family.id]
+        result = as_type_mask(self.assignments.get(family.id, None))
+        self.cache[family.id] = result
+        return result
 
 
-@attr.s(frozen=True)
+@attr.s(slots=True, frozen=True, eq=False)
 class FromName(object):
-    informative_names = attr.ib(validator=is_a(dict))
+    combined = attr.ib()
+    rna_types = attr.ib()
+    automaton = attr.ib(default=None)
+    cache = attr.ib(default=attr.Factory(dict), repr=False)
 
     @classmethod
-    def build(cls, filename):
-        with open(filename, 'r', 'utf-8') as handle:
-            loaded = json.load(handle)
-            return cls(
-                informative_names=loaded['informative_names'],
-            )
+    def build(cls, loaded):
+        names = loaded['informative_names']
+        # A single alternation with one named group per pattern lets the
+        # regex engine scan each name once, instead of one search per
+        # pattern per family.
+        combined = '|'.join(
+            '(?P<g%i>%s)' % (index, pattern)
+            for index, pattern in enumerate(names.keys())
+        )
+
+        # The informative names are all literal substrings today, so when
+        # pyahocorasick is available match them with one pass of an
+        # Aho-Corasick automaton. If a pattern ever grows real regex
+        # syntax, or the library is missing, the combined regex still
+        # handles it.
+        automaton = None
+        meta = set('.^$*+?{}[]|()\\')
+        if ahocorasick is not None and all(not meta & set(p) for p in names):
+            automaton = ahocorasick.Automaton()
+            for index, (pattern, rna_type) in enumerate(names.items()):
+                automaton.add_word(pattern.lower(), (index, rna_type))
+            automaton.make_automaton()
+
+        return cls(
+            combined=re.compile(combined, re.IGNORECASE),
+            rna_types=tuple(names.values()),
+            automaton=automaton,
+        )
 
     @property
     def name(self):
         return 'name'
 
     def __call__(self, family):
-        for pattern, rna_type in self.informative_names.items():
-            if re.search(pattern, family.name, re.IGNORECASE):
-                return InferredRfamType.build(family, self.name, rna_type)
-        return InferredRfamType.build(family, self.name, None)
+        if family.id in self.cache:
+            return self.cache[family.id]
+
+        rna_type = None
+        if self.automaton is not None:
+            # Keep the first pattern in file order when several match,
+            # like the old pattern-by-pattern search did.
+            found = None
+            for _, (index, value) in self.automaton.iter(family.name.lower()):
+                if found is None or index < found[0]:
+                    found = (index, value)
+            if found is not None:
+                rna_type = found[1]
+        else:
+            match = self.combined.search(family.name)
+            if match:
+                rna_type = self.rna_types[int(match.lastgroup[1:])]
+
+        result = as_type_mask(rna_type)
+        self.cache[family.id] = result
+        return result
 
 
-@attr.s()
+@attr.s(slots=True, frozen=True, eq=False)
 class FromRnaType(object):
-    mapping = attr.ib(validator=is_a(dict))
+    mapping = attr.ib()
 
     @classmethod
-    def build(cls, filename):
-        with open(filename, 'r', 'utf-8') as handle:
-            loaded = json.load(handle)
-            given = loaded['rna_type_mapping']
-            return cls(
-                mapping={rna_type_to_key(r): v for r, v in given.items()}
-            )
+    def build(cls, loaded):
+        # Only a few dozen distinct rna_type tuples exist across Rfam, so
+        # resolve every mapped value to its bitmask up front and a call is
+        # a single dict lookup.
+        given = loaded['rna_type_mapping']
+        return cls(
+            mapping={rna_type_to_key(r): as_type_mask(v) for r, v in given.items()}
+        )
 
     @property
     def name(self):
         return 'rna-type'
 
     def __call__(self, family):
-        return InferredRfamType.build(
-            family,
-            self.name,
-            self.mapping.get(family.rna_type, None)
-        )
+        return self.mapping.get(family.rna_type, 0)
 
 
-@attr.s()
+@attr.s(slots=True, frozen=True, eq=False)
 class FromSoTerms(object):
-    mapping = attr.ib(validator=is_a(dict))
+    mapping = attr.ib()
+    cache = attr.ib(default=attr.Factory(dict), repr=False)
 
     @classmethod
-    def build(cls, manual_file):
-        with open(manual_file, 'r', 'utf-8') as handle:
-            loaded = json.load(handle)
-            return cls(mapping=loaded['assignments'])
+    def build(cls, loaded):
+        # Resolve the assignment names to type bits up front, so a call is
+        # only bit operations over already resolved values.
+        mapping = {}
+        for so_term, rna_type in loaded['assignments'].items():
+            if rna_type == 'antisense':
+                rna_type = 'antisense_RNA'
+            mapping[so_term] = TYPE_BIT[getattr(INSDCTypes, rna_type)]
+        return cls(mapping=mapping)
 
     @property
     def name(self):
         return 'so-term'
 
     def __call__(self, family):
-        mapped = set(self.mapping.get(so, None) for so in family.so_terms)
-        return InferredRfamType.build(
-            family,
-            self.name,
-            mapped
-        )
+        if family.id in self.cache:
+            return self.cache[family.id]
+        result = 0
+        for so in family.so_terms:
+            result |= self.mapping.get(so, 0)
+        self.cache[family.id] = result
+        return result
 
 
-@attr.s()
+@attr.s(slots=True, frozen=True, eq=False)
 class SoTermSearch(object):
-    graph = attr.ib()
-    max_depth = attr.ib(validator=is_a(int))
+    lookup = attr.ib()
 
     @classmethod
-    def build(cls, manual_file, filename, max_depth):
-        with open(manual_file, 'r', 'utf-8') as handle:
-            loaded = json.load(handle)
-            assignments = loaded['assignments']
+    def build(cls, loaded, filename, max_depth):
+        assignments = loaded['assignments']
 
         graph = read_obo(filename)
+
+        # Flatten the MultiDiGraph into plain predecessor lists, so the
+        # walk below iterates python lists instead of re-creating networkx
+        # edge iterators and per-edge dicts at every level.
+        predecessors = {
+            term: list(parents)
+            for term, parents in graph.pred.items()
+        }
+
+        # Rather than searching up the tree depth by depth for each family,
+        # walk the reversed graph once from every assigned term. The first
+        # level at which a term is reached gives its nearest assigned
+        # ancestors, which is what the old depth-by-depth search found.
+        lookup = {}
+        level = coll.defaultdict(int)
         for so_term, isndc in assignments.items():
-            graph.node[so_term]['isndc'] = isndc
+            if so_term in predecessors:
+                if isndc == 'antisense':
+                    isndc = 'antisense_RNA'
+                level[so_term] |= TYPE_BIT[getattr(INSDCTypes, isndc)]
 
-        return cls(
-            graph=graph,
-            max_depth=max_depth
-        )
+        for depth in range(0, max_depth):
+            for term, found in level.items():
+                if term not in lookup:
+                    lookup[term] = found
+
+            next_level = coll.defaultdict(int)
+            for term, found in level.items():
+                for child in predecessors[term]:
+                    next_level[child] |= found
+            level = next_level
+
+        return cls(lookup=lookup)
 
     @property
     def name(self):
         return 'so-search'
 
-    def dfs(self, term, depth):
-        if term not in self.graph:
-            return set()
-        node = self.graph.node[term]
-        if not depth and 'isndc' in node:
-            return set([node['isndc']])
-
-        if depth:
-            found = set()
-            edges = self.graph.out_edges_iter(term, data=True)
-            for (_, child, data) in edges:
-                found.update(self.dfs(child, depth - 1))
-            return found
-        return set()
-
-    def search(self, root):
-        for depth in range(0, self.max_depth):
-            found = self.dfs(root, depth)
-            if found:
-                return found
-        return set()
-
     def __call__(self, family):
-        rna_types = set()
+        rna_types = 0
         for so_term in family.so_terms:
-            rna_types.update(self.search(so_term))
-        return InferredRfamType.build(family, self.name, rna_types)
+            rna_types |= self.lookup.get(so_term, 0)
+        return rna_types
 
 
-@attr.s()
+@attr.s(slots=True, frozen=True, eq=False)
 class WithFallBacks(object):
-    from_manual = attr.ib(validator=is_a(ManualInference))
-    from_name = attr.ib(validator=is_a(FromName))
-    from_rna_type = attr.ib(validator=is_a(FromRnaType))
-    from_so_terms = attr.ib(validator=is_a(FromSoTerms))
-    so_term_search = attr.ib(validator=is_a(SoTermSearch))
+    from_manual = attr.ib()
+    from_name = attr.ib()
+    from_rna_type = attr.ib()
+    from_so_terms = attr.ib()
+    so_term_search = attr.ib()
 
     @classmethod
     def build(cls, manual_file, obo_file, max_depth):
+        # Parse the manual file once and hand the loaded data to each
+        # method, instead of each build re-reading the same JSON.
+        loaded = load_json(manual_file)
+
         return cls(
-            from_manual=ManualInference.build(manual_file),
-            from_name=FromName.build(manual_file),
-            from_rna_type=FromRnaType.build(manual_file),
-            from_so_terms=FromSoTerms.build(manual_file),
-            so_term_search=SoTermSearch.build(manual_file, obo_file, max_depth),
+            from_manual=ManualInference.build(loaded),
+            from_name=FromName.build(loaded),
+            from_rna_type=FromRnaType.build(loaded),
+            from_so_terms=FromSoTerms.build(loaded),
+            so_term_search=SoTermSearch.build(loaded, obo_file, max_depth),
         )
 
     @property
     def name(self):
         return 'fallbacks'
 
-    def simplify(self, result):
-        if not result:
-            return result
-
+    def simplify(self, rna_types):
         # Remove misc_RNA if possible.
-        if len(result) > 1 and INSDCTypes.misc_RNA in result:
-            result = result.remove(INSDCTypes.misc_RNA)
+        misc = TYPE_BIT[INSDCTypes.misc_RNA]
+        if rna_types & misc and rna_types & ~misc:
+            rna_types &= ~misc
 
         # Remove other if possible. We remove misc_RNA first because other is
         # more specific.
-        if len(result) > 1 and INSDCTypes.other in result:
-            result = result.remove(INSDCTypes.other)
+        other = TYPE_BIT[INSDCTypes.other]
+        if rna_types & other and rna_types & ~other:
+            rna_types &= ~other
 
-        return result
+        return rna_types
 
     def __call__(self, family):
-        result = self.from_manual(family) or \
-            self.from_name(family) or \
-            self.from_so_terms(family) or \
-            self.from_rna_type(family)
-
-        if not result:
-            possible = self.so_term_search(family)
-            if possible and possible.rna_types != {INSDCTypes.other}:
-                result = possible
-
-        if not result:
+        # Each method returns a bare type mask; only the surviving result
+        # gets wrapped in an InferredRfamType.
+        methods = (
+            self.from_manual,
+            self.from_name,
+            self.from_so_terms,
+            self.from_rna_type,
+        )
+        for method in methods:
+            rna_types = method(family)
+            if rna_types:
+                return InferredRfamType(
+                    family=family,
+                    method=method.name,
+                    rna_types=self.simplify(rna_types),
+                )
+
+        possible = self.so_term_search(family)
+        if possible and possible != TYPE_BIT[INSDCTypes.other]:
             return InferredRfamType(
                 family=family,
-                method=self.name,
-                rna_types=frozenset()
+                method=self.so_term_search.name,
+                rna_types=self.simplify(possible),
             )
 
-        return self.simplify(result)
+        return InferredRfamType(
+            family=family,
+            method=self.name,
+            rna_types=0
+        )
 
 
 # @click.group()
@@ -364,6 +461,20 @@ class WithFallBacks(object):
 #     pass
 
 
+# Workers inherit the built inference object through fork, so the ontology
+# lookup tables are shared copy-on-write instead of being pickled per task.
+_inference = None
+
+
+def infer_row(family):
+    result = _inference(family)
+    return [
+        family.id,
+        result.method,
+        ';'.join(mask_to_names(result.rna_types)),
+    ]
+
+
 @click.command('infer')
 @click.argument('link_file')
 @click.argument('family_file')
@@ -378,10 +489,19 @@ def main(link_file, family_file, obo_file, manual_file, max_depth):
         max_depth,
     )
 
-    headers = [f.name for f in attr.fields(InferredRfamType)]
-    writer = csv.DictWriter(sys.stdout, fieldnames=headers)
-    writer.writeheader()
-    writer.writerows(inference(family).simple() for family in families)
+    global _inference
+    _inference = inference
+
+    out = io.TextIOWrapper(sys.stdout.buffer, newline='')
+    writer = csv.writer(out)
+    writer.writerow(['family', 'method', 'rna_types'])
+
+    # Each family is independent, so fan the work out across cores. imap
+    # keeps the output in family order.
+    with mp.get_context('fork').Pool() as pool:
+        for row in pool.imap(infer_row, families, chunksize=64):
+            writer.writerow(row)
+    out.flush()
 
 
 if __name__ == "__main__":